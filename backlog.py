@@ -0,0 +1,122 @@
+import datetime
+import math
+import time
+
+import sqlalchemy
+
+from config import env_int
+from database import Clk, ClkStatus, db_session, Project, ThroughputSample
+
+
+# Rows in these states are waiting for a worker.
+OUTSTANDING_STATUSES = (ClkStatus.QUEUED, ClkStatus.IN_PROGRESS)
+
+# Throughput is averaged over this many recent seconds.
+THROUGHPUT_WINDOW = env_int('CLKHASH_SERVICE_THROUGHPUT_WINDOW', 300)
+
+# Seconds between prunes of old throughput samples by one process.
+_PRUNE_INTERVAL = 60
+_last_prune = None
+
+
+def outstanding_rows(project_id=None):
+    """Number of rows not yet hashed, in one project or in total.
+
+    Read from the per-project counters, so this never counts clks.
+    """
+    if project_id is not None:
+        count = db_session.query(Project.outstanding_count).filter(
+                Project.id == project_id
+            ).scalar()
+        return count or 0
+    return db_session.query(
+            sqlalchemy.func.coalesce(
+                sqlalchemy.func.sum(Project.outstanding_count), 0)
+        ).scalar()
+
+
+def add_outstanding(project_id, row_count):
+    """Add `row_count` (which may be negative) to a project's counter.
+
+    Does not commit, so the change lands with the clks it counts.
+    """
+    db_session.query(Project).filter(
+            Project.id == project_id
+        ).update({
+            Project.outstanding_count:
+                Project.outstanding_count + row_count
+        }, synchronize_session=False)
+
+
+def lock_outstanding(project_id, indices):
+    """Lock the clks at `indices` that are still outstanding, and return
+    how many there are.
+
+    The clks stay locked until the transaction ends, so two deliveries
+    of the same chunk cannot both take them off the project's counter.
+    Does not commit.
+    """
+    return len(db_session.query(Clk.index).filter(
+            Clk.project_id == project_id,
+            Clk.index.in_(indices),
+            Clk.status.in_(OUTSTANDING_STATUSES)
+        ).order_by(Clk.index).with_for_update().all())
+
+
+def record_throughput(row_count):
+    """Record that a worker finished `row_count` rows just now.
+
+    Does not commit, so the sample lands with the hashes.
+    """
+    db_session.add(ThroughputSample(row_count=row_count))
+
+
+def prune_throughput():
+    """Delete samples that have left the window, and commit.
+
+    Kept out of the hashing transactions, which would otherwise all
+    contend for the same old samples. Does nothing if this process
+    pruned within the last `_PRUNE_INTERVAL` seconds.
+    """
+    global _last_prune
+    now = time.monotonic()
+    if _last_prune is not None and now - _last_prune < _PRUNE_INTERVAL:
+        return
+    _last_prune = now
+
+    cutoff = (datetime.datetime.utcnow()
+              - datetime.timedelta(seconds=THROUGHPUT_WINDOW))
+    db_session.query(ThroughputSample).filter(
+            ThroughputSample.finished_at < cutoff
+        ).delete(synchronize_session=False)
+    db_session.commit()
+
+
+def throughput():
+    """Rows per second hashed by all workers over the recent window.
+
+    Workers prune samples outside the window about once a minute, so
+    this sums little more than one window's worth of samples.
+    """
+    cutoff = (datetime.datetime.utcnow()
+              - datetime.timedelta(seconds=THROUGHPUT_WINDOW))
+    rows = db_session.query(
+            sqlalchemy.func.sum(ThroughputSample.row_count)
+        ).filter(
+            ThroughputSample.finished_at >= cutoff
+        ).scalar()
+    return (rows or 0) / THROUGHPUT_WINDOW
+
+
+def seconds_to_drain(row_count, rate=None):
+    """Estimate seconds until `row_count` rows are hashed.
+
+    Returns None when no throughput has been observed recently.
+    """
+    if row_count <= 0:
+        return 0
+    if rate is None:
+        rate = throughput()
+    if rate <= 0:
+        return None
+    return math.ceil(row_count / rate)
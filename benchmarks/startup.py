@@ -0,0 +1,61 @@
+"""Measure the cold-start time of the app and the worker.
+
+Each measurement runs in a fresh interpreter, so nothing is cached
+between runs. Run from the repository root with the same environment
+variables as the service; the first request needs the database:
+
+    python benchmarks/startup.py [--runs N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_APP_SCRIPT = '''
+import json, time
+start = time.perf_counter()
+import clkhash_service
+imported = time.perf_counter()
+client = clkhash_service.flask_app.test_client()
+response = client.get('/projects/')
+assert response.status_code == 200, response.status_code
+done = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first request': done - imported}))
+'''
+
+_WORKER_SCRIPT = '''
+import json, time
+start = time.perf_counter()
+import clkhash_worker
+print(json.dumps({'import': time.perf_counter() - start}))
+'''
+
+
+def _measure(script):
+    output = subprocess.run([sys.executable, '-c', script],
+                            cwd=_REPO_ROOT, check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True
+                            ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5,
+                        help='number of fresh interpreters per measurement')
+    args = parser.parse_args()
+
+    for name, script in [('app', _APP_SCRIPT), ('worker', _WORKER_SCRIPT)]:
+        runs = [_measure(script) for _ in range(args.runs)]
+        for key in runs[0]:
+            times = [run[key] for run in runs]
+            print('{} {}: median {:.3f}s, min {:.3f}s, max {:.3f}s'.format(
+                name, key, statistics.median(times), min(times), max(times)))
+
+
+if __name__ == '__main__':
+    main()
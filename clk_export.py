@@ -0,0 +1,90 @@
+import os
+import struct
+import urllib.parse
+
+
+# Each part file holds the DONE clks of an index range in a columnar
+# layout: a header, then every index as a little-endian uint32, then
+# every hash back to back. All hashes in a project have the same size.
+FORMAT_NAME = 'clkx'
+FORMAT_VERSION = 1
+_MAGIC = b'CLKX'
+_HEADER = struct.Struct('<4sBxxxII')  # magic, version, count, hash size
+
+
+def encode_part(clks):
+    """Serialise `(index, hash)` pairs into the part file format."""
+    indices = []
+    hashes = []
+    for index, hash_ in clks:
+        indices.append(index)
+        hashes.append(hash_)
+
+    hash_size = len(hashes[0]) if hashes else 0
+    if any(len(hash_) != hash_size for hash_ in hashes):
+        raise ValueError('clks in a part must all have the same size')
+
+    return b''.join([
+        _HEADER.pack(_MAGIC, FORMAT_VERSION, len(indices), hash_size),
+        struct.pack('<{}I'.format(len(indices)), *indices),
+        *hashes])
+
+
+def decode_part(data):
+    """Inverse of `encode_part`: return a list of `(index, hash)` pairs."""
+    magic, version, count, hash_size = _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != FORMAT_VERSION:
+        raise ValueError('not a {} v{} file'.format(FORMAT_NAME,
+                                                   FORMAT_VERSION))
+    indices = struct.unpack_from('<{}I'.format(count), data, _HEADER.size)
+    hashes_start = _HEADER.size + 4 * count
+    return [(index,
+             data[hashes_start + i * hash_size:
+                  hashes_start + (i + 1) * hash_size])
+            for i, index in enumerate(indices)]
+
+
+class LocalSink:
+    """Write exported parts under a directory of the local filesystem."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def write(self, key, data):
+        directory = os.path.abspath(self.directory)
+        path = os.path.abspath(os.path.join(directory, key))
+        if os.path.commonpath([directory, path]) != directory:
+            raise ValueError('key {!r} is outside the sink'.format(key))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so readers never see a partial part.
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return 'file://' + urllib.parse.quote(os.path.abspath(path))
+
+
+class S3Sink:
+    """Write exported parts to an S3-compatible object store."""
+
+    def __init__(self, bucket, prefix, endpoint_url=None):
+        import boto3  # Slow to import; only needed here.
+        self.bucket = bucket
+        self.prefix = prefix
+        self._client = boto3.client('s3', endpoint_url=endpoint_url)
+
+    def write(self, key, data):
+        key = '/'.join(filter(None, [self.prefix, key]))
+        self._client.put_object(Bucket=self.bucket, Key=key, Body=data)
+        return 's3://{}/{}'.format(self.bucket, key)
+
+
+def sink_from_uri(uri, s3_endpoint_url=None):
+    """Make a sink from `file:///path` or `s3://bucket/prefix`."""
+    parsed = urllib.parse.urlparse(uri)
+    if parsed.scheme == 'file':
+        return LocalSink(urllib.parse.unquote(parsed.path))
+    elif parsed.scheme == 's3':
+        return S3Sink(parsed.netloc, parsed.path.strip('/'), s3_endpoint_url)
+    else:
+        raise ValueError('unsupported export URI {!r}'.format(uri))
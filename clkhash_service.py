@@ -1,27 +1,73 @@
 import base64
+import collections
 import csv
-import functools
 import io
 import itertools
 import json
 import os
 import urllib.parse
+import uuid
 
-import clkhash
-import clkhash.validate_data
 import connexion
 import sqlalchemy
 import sqlalchemy.exc
 import sqlalchemy.orm
-import sqlalchemy.sql
-from flask import abort, jsonify, Response, request
+from flask import abort, jsonify, Response, request, stream_with_context
 
-import clkhash_worker
-from database import Clk, db_session, ClkStatus, Project
+import backlog
+import clk_export
+import database
+import hash_store
+import pii_codec
+import project_cache
+import task_client
+from config import env_bool, env_int
+from database import (Clk, db_session, ClkStatus, Export, ExportPart,
+                      ExportPartStatus, Project)
 
 
 CHUNK_SIZE = 1000
 
+# Uploads that take the rows waiting to be hashed in their project over
+# this default to low priority.
+BULK_UPLOAD_ROWS = env_int('CLKHASH_SERVICE_BULK_UPLOAD_ROWS', 100000)
+
+# Number of clk indices in each file of an export.
+EXPORT_PART_SIZE = env_int('CLKHASH_SERVICE_EXPORT_PART_SIZE', 100000)
+
+# Limits on rows waiting to be hashed; 0 means unlimited.
+MAX_OUTSTANDING_ROWS = env_int('CLKHASH_SERVICE_MAX_OUTSTANDING_ROWS', 0)
+MAX_OUTSTANDING_ROWS_PER_PROJECT = env_int(
+    'CLKHASH_SERVICE_MAX_OUTSTANDING_ROWS_PER_PROJECT', 0)
+# Retry-After when there is no recent throughput to estimate it from.
+DEFAULT_RETRY_AFTER = env_int('CLKHASH_SERVICE_DEFAULT_RETRY_AFTER', 60)
+
+_project_cache = project_cache.ProjectCache(
+    maxsize=env_int('CLKHASH_SERVICE_PROJECT_CACHE_SIZE', 1024),
+    ttl=env_int('CLKHASH_SERVICE_PROJECT_CACHE_TTL', 60))
+
+# Optional local copy of finished hashes, for fast repeated downloads.
+_HASH_STORE_DIR = os.environ.get('CLKHASH_SERVICE_HASH_STORE_DIR')
+_hash_store = (hash_store.HashStore(
+                   _HASH_STORE_DIR,
+                   max_bytes=env_int('CLKHASH_SERVICE_HASH_STORE_MAX_MB',
+                                     1024) * 2**20)
+               if _HASH_STORE_DIR
+               else None)
+
+
+def _invalidate_project(project_id):
+    """Forget everything held locally about `project_id`."""
+    _project_cache.invalidate(project_id)
+    if _hash_store is not None:
+        _hash_store.drop(project_id)
+
+
+def _notify_invalidations():
+    """Whether replicas tell each other about deleted projects."""
+    return database.get_engine().dialect.name == 'postgresql'
+
+
 connexion_app = connexion.App(__name__)
 flask_app = connexion_app.app
 
@@ -32,10 +78,24 @@ _DELETE_SUCCESS_RESPONSE = Response(status=204)
 del _DELETE_SUCCESS_RESPONSE.headers['Content-Type']
 
 
-def _abort_with_msg(msg, status):
-    """Abort with specified message and status code."""
+@flask_app.before_first_request
+def _start_invalidation_listener():
+    # Deferred so that importing the app does not touch the database.
+    if (_notify_invalidations()
+            and (_project_cache.maxsize > 0 or _hash_store is not None)
+            and not database.TRANSACTION_POOLING
+            and env_bool('CLKHASH_SERVICE_PROJECT_CACHE_LISTEN', True)):
+        project_cache.start_invalidation_listener(database.get_engine(),
+                                                  _invalidate_project,
+                                                  _project_cache.clear)
+
+
+def _abort_with_msg(msg, status, headers=None):
+    """Abort with specified message, status code, and headers."""
     response = jsonify(errMsg=msg)
     response.status_code = status
+    if headers is not None:
+        response.headers.extend(headers)
     abort(response)
 
 
@@ -44,11 +104,37 @@ def _abort_project_id_not_found(project_id):
     _abort_with_msg("no such project '{}'".format(project_id), 404)
 
 
+def _get_project_metadata(project_id, generation=None):
+    """Return ProjectMetadata of `project_id`, or None if no project.
+
+    Served from the process-local project cache when possible. Pass the
+    project's `generation` to reload a cached entry that belongs to an
+    earlier project with the same ID.
+    """
+    metadata = _project_cache.get(project_id)
+    if (metadata is None
+            or (generation is not None
+                and metadata.generation != generation)):
+        project = db_session.query(Project).options(
+                sqlalchemy.orm.load_only(Project.schema, Project.generation)
+            ).filter(
+                Project.id == project_id
+            ).one_or_none()
+        if project is None:
+            return None
+
+        import clkhash.schema  # Slow to import; only needed here.
+        metadata = project_cache.ProjectMetadata(
+            schema_dict=project.schema,
+            schema=clkhash.schema.from_json_dict(project.schema),
+            generation=project.generation)
+        _project_cache.put(project_id, metadata)
+    return metadata
+
+
 def _does_project_exist(project_id):
     """Returns True iff project with ID `project_id` exists."""
-    return db_session.query(
-            sqlalchemy.sql.exists().where(Project.id == project_id)
-        ).scalar()
+    return _get_project_metadata(project_id) is not None
 
 
 def _str_to_status_or_abort(status_str):
@@ -60,15 +146,20 @@ def _str_to_status_or_abort(status_str):
     return status_enum
 
 
-def _abort_if_project_not_found(function):
-    @functools.wraps(function)
-    def retval(project_id, *args, **kwargs):
+def _nonempty_or_abort_if_project_not_found(project_id, iterable):
+    """Return iterator over `iterable`; abort if empty and no project.
+
+    Only checks for the project when `iterable` is empty, so the common
+    case costs a single query rather than an extra existence check.
+    """
+    iterator = iter(iterable)
+    try:
+        first = next(iterator)
+    except StopIteration:
         if not _does_project_exist(project_id):
             _abort_project_id_not_found(project_id)
-        else:
-            return function(project_id, *args, **kwargs)
-
-    return retval
+        return iter(())
+    return itertools.chain((first,), iterator)
 
 
 def _intersperse(iterable, item):
@@ -101,6 +192,54 @@ def _make_clk_query(project_id, index_range_start, index_range_end, status):
     return query
 
 
+def _abort_if_backlog_full(project_id, records_num):
+    """Roll back and abort if accepting `records_num` rows would exceed
+    the limits.
+
+    The check is not atomic with the insert, so concurrent uploads may
+    overshoot a limit slightly.
+    """
+    for limit, limit_project_id in [
+            (MAX_OUTSTANDING_ROWS_PER_PROJECT, project_id),
+            (MAX_OUTSTANDING_ROWS, None)]:
+        if limit <= 0:
+            continue
+
+        if records_num > limit:
+            msg = ('Upload of {} rows exceeds the limit of {} rows waiting '
+                   'to be hashed. Split it into smaller uploads.'
+                   .format(records_num, limit))
+            db_session.rollback()
+            _abort_with_msg(msg, 413)
+
+        excess = (backlog.outstanding_rows(limit_project_id)
+                  + records_num - limit)
+        if excess > 0:
+            retry_after = backlog.seconds_to_drain(excess)
+            if retry_after is None:
+                retry_after = DEFAULT_RETRY_AFTER
+            msg = 'Too many rows waiting to be hashed. Try again later.'
+            db_session.rollback()
+            _abort_with_msg(msg, 429,
+                            headers={'Retry-After': str(retry_after)})
+
+
+def get_backlog():
+    outstanding = backlog.outstanding_rows()
+    rate = backlog.throughput()
+    return {
+        'outstandingRows': outstanding,
+        'throughputRowsPerSecond': rate,
+        'estimatedSecondsToDrain': backlog.seconds_to_drain(outstanding, rate)
+    }
+
+
+def get_stats():
+    return {
+        'projectCache': _project_cache.stats()
+    }
+
+
 def get_projects():
     project_ids = db_session.query(Project.id)
     return {
@@ -108,7 +247,9 @@ def get_projects():
     }
 
 
-def post_project(project_id, secret_key, body):
+def post_project(project_id, secret_key, body, dedup=False):
+    import clkhash.schema  # Slow to import; only needed here.
+
     schema = body
     # Check that the schema is valid.
     try:
@@ -130,7 +271,8 @@ def post_project(project_id, secret_key, body):
     project = Project(
         id=project_id,
         schema=schema,
-        key=b64_secret_key)
+        key=b64_secret_key,
+        dedup=dedup)
     db_session.add(project)
 
     try:
@@ -144,33 +286,35 @@ def post_project(project_id, secret_key, body):
 
 
 def get_project(project_id):
-    project = db_session.query(Project).options(
-            sqlalchemy.orm.load_only(Project.schema)
-        ).filter(
-            Project.id == project_id
-        ).one_or_none()
-
-    if project is None:
+    metadata = _get_project_metadata(project_id)
+    if metadata is None:
         _abort_project_id_not_found(project_id)
 
     # We're purposefully not exposing the keys.
     return {
             'projectId': project_id,
-            'schema': project.schema
+            'schema': metadata.schema_dict
         }
 
 
 def delete_project(project_id):
+    # Clks before the project, which is the order in which workers lock
+    # them, so that deleting a project being hashed cannot deadlock.
+    db_session.query(Clk).filter(Clk.project_id == project_id).delete()
     delete_count = db_session.query(Project).filter(
             Project.id == project_id
         ).delete()
 
     if delete_count == 0:
+        db_session.rollback()
         _abort_project_id_not_found(project_id)
     elif delete_count == 1:
-        # Delete clks also.
-        db_session.query(Clk).filter(Clk.project_id == project_id).delete()
+        if _notify_invalidations():
+            # Delivered to the other replicas on commit.
+            db_session.execute(sqlalchemy.select(sqlalchemy.func.pg_notify(
+                project_cache.INVALIDATION_CHANNEL, project_id)))
         db_session.commit()
+        _invalidate_project(project_id)
 
         return _DELETE_SUCCESS_RESPONSE
     else:
@@ -180,28 +324,37 @@ def delete_project(project_id):
             .format(delete_count))
 
 
-def _first_last(iterable):
-    iterator = iter(iterable)
-    try:
-        first = last = next(iterator)
-    except StopIteration:
-        raise ValueError('empty iterable')
+def _make_clk_group_query(project_id, index_range_start, index_range_end):
+    """Query runs of consecutive clks with the same status.
 
-    for last in iterator:
-        pass
+    Within a status, consecutive indices have the same difference
+    between the index and the clk's rank in that status, so grouping by
+    status and that difference gives the runs (gaps and islands). Only
+    one row per run leaves the database.
+    """
+    island = Clk.index - sqlalchemy.func.row_number().over(
+        partition_by=Clk.status, order_by=Clk.index)
+    clks = _make_clk_query(project_id,
+                           index_range_start, index_range_end,
+                           None).with_entities(
+            Clk.status, Clk.index, island.label('island')
+        ).subquery()
 
-    return first, last
+    range_start = sqlalchemy.func.min(clks.c.index)
+    return db_session.query(
+            clks.c.status,
+            range_start,
+            sqlalchemy.func.max(clks.c.index) + 1
+        ).group_by(
+            clks.c.status, clks.c.island
+        ).order_by(range_start)
 
 
-def _group_clks(clks):
-    for _, group in itertools.groupby(
-            enumerate(clks),
-            key=lambda x: (x[1].status,          # Group by status and
-                           x[1].index - x[0])):  # by offset from start.
-        (_, first_clk), (_, last_clk) = _first_last(group)
-        yield {'status': first_clk.status.value,
-               'rangeStart': first_clk.index,
-               'rangeEnd': last_clk.index + 1}
+def _clk_group_to_dict(clk_group):
+    status, range_start, range_end = clk_group
+    return {'status': status.value,
+            'rangeStart': range_start,
+            'rangeEnd': range_end}
 
 
 def _stream_clk_groups(clk_groups):
@@ -210,21 +363,27 @@ def _stream_clk_groups(clk_groups):
     yield ']}'
 
 
-@_abort_if_project_not_found
-def get_clks_status(project_id):
-    clks = db_session.query(Clk).filter(
-            Clk.project_id == project_id
-        ).options(
-            sqlalchemy.orm.load_only(Clk.index, Clk.status)
-        ).order_by(Clk.index)
+def get_clks_status(project_id, index_range_start=None, index_range_end=None):
+    clk_groups = _make_clk_group_query(project_id,
+                                       index_range_start, index_range_end)
+    clk_groups = _nonempty_or_abort_if_project_not_found(project_id,
+                                                         clk_groups)
 
-    clk_groups = _group_clks(clks)
+    clk_groups = map(_clk_group_to_dict, clk_groups)
     clk_group_stream = _stream_clk_groups(clk_groups)
     return Response(clk_group_stream, content_type='application/json')
 
 
-@_abort_if_project_not_found
-def post_pii(project_id, body, header, validate):
+def _pii_projection(schema, validate):
+    """Which columns the worker reads: those it hashes or validates."""
+    import clkhash.field_formats  # Slow to import.
+    return [field.hashing_properties is not None
+            or (validate
+                and not isinstance(field, clkhash.field_formats.Ignore))
+            for field in schema.fields]
+
+
+def post_pii(project_id, body, header, validate, priority=None):
     pii_table = body
     pii_table = pii_table.decode(request.charset)
     pii_table_stream = io.StringIO(pii_table)
@@ -235,45 +394,48 @@ def post_pii(project_id, body, header, validate):
             headings = next(reader)
         except StopIteration:
             _abort_with_msg('Header expected but not present.', 422)
-        
-        if header == 'true':
-            project = db_session.query(Project).options(
-                sqlalchemy.orm.load_only(Project.schema)
-            ).filter(
-                Project.id == project_id
-            ).one_or_none()
-
-            if project is None:
-                # Project deleted in the meantime
-                _abort_project_id_not_found(project_id)
-
-            schema = clkhash.schema.from_json_dict(project.schema)
-            try:
-                clkhash.validate_data.validate_header(schema.fields, headings)
-            except clkhash.validate_data.FormatError as e:
-                msg, *_ = e.args
-                _abort_with_msg(msg, 422)
 
     pii_table = tuple(reader)
     records_num = len(pii_table)
+    for line, row in enumerate(pii_table, start=1):
+        if len(row) > pii_codec.MAX_COLUMNS:
+            msg = 'Row {} has more than {} columns.'.format(
+                line, pii_codec.MAX_COLUMNS)
+            _abort_with_msg(msg, 422)
 
     # Atomically increase clk counter to reserve space for PII.
     stmt = sqlalchemy.update(Project).where(
             Project.id == project_id
         ).values(
             clk_count=Project.clk_count + records_num
-        ).returning(Project.clk_count)
-    result = db_session.execute(stmt)
-    db_session.commit()
-    
-    result_scalar = result.scalar()
-    if result_scalar is None:
-        # Project deleted in the meantime
+        ).returning(Project.clk_count, Project.generation)
+    result = db_session.execute(stmt).one_or_none()
+    if result is None:
+        db_session.rollback()
         _abort_project_id_not_found(project_id)
+    clk_count, generation = result
+    # Only once we know that the project exists.
+    _abort_if_backlog_full(project_id, records_num)
+
+    # The schema the workers will hash with. A cached one may belong to
+    # a project deleted since, on another replica.
+    metadata = _get_project_metadata(project_id, generation)
+    if header == 'true':
+        import clkhash.validate_data  # Slow to import.
+        try:
+            clkhash.validate_data.validate_header(
+                metadata.schema.fields, headings)
+        except clkhash.validate_data.FormatError as e:
+            db_session.rollback()
+            msg, *_ = e.args
+            _abort_with_msg(msg, 422)
+    db_session.commit()
 
-    start_index = result_scalar - records_num
+    start_index = clk_count - records_num
+    projection = _pii_projection(metadata.schema, validate)
     clk_mappings = [
-        dict(project_id=project_id, index=i, status=ClkStatus.QUEUED, pii=row)
+        dict(project_id=project_id, index=i, status=ClkStatus.QUEUED,
+             pii_packed=pii_codec.pack(row, projection))
         for i, row in enumerate(pii_table, start=start_index)]
     try:
         db_session.bulk_insert_mappings(Clk, clk_mappings)
@@ -282,15 +444,25 @@ def post_pii(project_id, body, header, validate):
         _abort_project_id_not_found(project_id)
 
     # Queue up for the worker.
+    if priority is None:
+        # Count the project's backlog too, so that a large job sent as
+        # many small uploads does not stay ahead of other projects.
+        project_backlog = backlog.outstanding_rows(project_id) + records_num
+        priority = 'low' if project_backlog > BULK_UPLOAD_ROWS else 'normal'
+    queue = task_client.PRIORITY_QUEUES[priority]
     end_index = start_index + records_num
     clk_indices = range(start_index, end_index)
     for i in range(0, clk_indices.stop - clk_indices.start, CHUNK_SIZE):
         this_indices = clk_indices[i:i + CHUNK_SIZE]
-        clkhash_worker.hash.delay(project_id,
-                                  validate,
-                                  this_indices.start,
-                                  this_indices.stop)
-
+        task_client.send_hash(project_id,
+                              validate,
+                              this_indices.start,
+                              this_indices.stop,
+                              queue)
+
+    # Last, so that workers of this project wait for the lock on its
+    # counter only briefly.
+    backlog.add_outstanding(project_id, records_num)
     # Only commit once we know that the queueing succeeded.
     db_session.commit()
 
@@ -302,6 +474,52 @@ def post_pii(project_id, body, header, validate):
         }, 202
 
 
+StoredClk = collections.namedtuple(
+    'StoredClk', ['index', 'status', 'err_msg', 'hash'])
+
+
+def _stored_clks(project_id, rows, batch_size=CHUNK_SIZE):
+    """Turn `(index, status, err_msg, generation)` rows into StoredClks.
+
+    Hashes come from the local hash store; those missing from it are
+    read from the database in one query per batch and stored. Runs
+    while the response streams, so the session is removed once the
+    last batch is read rather than left idle in a transaction.
+    """
+    rows = iter(rows)
+    try:
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return
+
+            # Projects from before generations were introduced have none.
+            _, _, _, generation = batch[0]
+            done_indices = [index for index, status, _, _ in batch
+                            if status == ClkStatus.DONE]
+            if generation is not None:
+                hashes = _hash_store.get_many(project_id, generation,
+                                              done_indices)
+            else:
+                hashes = {}
+
+            missing = [index for index in done_indices if index not in hashes]
+            if missing:
+                fetched = db_session.query(Clk.index, Clk.hash).filter(
+                        Clk.project_id == project_id,
+                        Clk.index.in_(missing),
+                        Clk.status == ClkStatus.DONE
+                    ).all()
+                if generation is not None:
+                    _hash_store.put_many(project_id, generation, fetched)
+                hashes.update(fetched)
+
+            for index, status, err_msg, _ in batch:
+                yield StoredClk(index, status, err_msg, hashes.get(index))
+    finally:
+        db_session.remove()
+
+
 def _clk_to_dict(clk):
     return {
         'index': clk.index,
@@ -347,7 +565,6 @@ def _stream_clks(clks, page_limit):
     yield '}'
 
 
-@_abort_if_project_not_found
 def get_clks(project_id,
              index_range_start=None,
              index_range_end=None,
@@ -376,6 +593,17 @@ def get_clks(project_id,
     query = _make_clk_query(project_id,
                             index_range_start, index_range_end,
                             status_enums)
+    if _hash_store is None:
+        query = query.options(
+                sqlalchemy.orm.load_only(
+                    Clk.index, Clk.status, Clk.err_msg, Clk.hash))
+    else:
+        # Read the generation in the same query, so we can never serve
+        # hashes stored for a deleted project with the same ID.
+        query = query.join(
+                Project, Project.id == Clk.project_id
+            ).with_entities(
+                Clk.index, Clk.status, Clk.err_msg, Project.generation)
     query = query.order_by(Clk.index)
 
     if page_limit is not None:
@@ -383,15 +611,18 @@ def get_clks(project_id,
         # if there are leftover elements.
         query = query.limit(page_limit + 1)
 
-    clks = query.options(
-            sqlalchemy.orm.load_only(
-                Clk.index, Clk.status, Clk.err_msg, Clk.hash))
+    clks = _nonempty_or_abort_if_project_not_found(project_id, query)
+    if _hash_store is None:
+        return Response(_stream_clks(clks, page_limit),
+                        content_type='application/json')
 
-    return Response(_stream_clks(clks, page_limit),
+    # The stream reads hashes from the database, after the request
+    # would otherwise have been torn down.
+    clks = _stored_clks(project_id, clks)
+    return Response(stream_with_context(_stream_clks(clks, page_limit)),
                     content_type='application/json')
 
 
-@_abort_if_project_not_found
 def delete_clks(project_id,
                 index_range_start=None,
                 index_range_end=None,
@@ -401,12 +632,106 @@ def delete_clks(project_id,
                             index_range_start, index_range_end,
                             status_enums)
 
-    query.delete(synchronize_session=False)
+    # Deleted in two steps to keep the count of outstanding clks.
+    outstanding_count = query.filter(
+            Clk.status.in_(backlog.OUTSTANDING_STATUSES)
+        ).delete(synchronize_session=False)
+    if outstanding_count:
+        backlog.add_outstanding(project_id, -outstanding_count)
+    delete_count = (outstanding_count
+                    + query.delete(synchronize_session=False))
+    if delete_count == 0 and not _does_project_exist(project_id):
+        db_session.rollback()
+        _abort_project_id_not_found(project_id)
     db_session.commit()
 
     return _DELETE_SUCCESS_RESPONSE
 
 
+def post_export(project_id):
+    clk_count = db_session.query(Project.clk_count).filter(
+            Project.id == project_id
+        ).scalar()
+    if clk_count is None:
+        _abort_project_id_not_found(project_id)
+
+    export_id = uuid.uuid4().hex
+    db_session.add(Export(id=export_id, project_id=project_id))
+    db_session.flush()
+    parts = [
+        dict(export_id=export_id, part=part, start_index=start_index,
+             end_index=min(start_index + EXPORT_PART_SIZE, clk_count),
+             status=ExportPartStatus.QUEUED)
+        for part, start_index in enumerate(
+            range(0, clk_count, EXPORT_PART_SIZE))]
+    db_session.bulk_insert_mappings(ExportPart, parts)
+    # Before queueing, so that workers always find the parts.
+    db_session.commit()
+
+    queue = task_client.PRIORITY_QUEUES['low']
+    for part in parts:
+        try:
+            task_client.send_export_part(export_id, part['part'], queue)
+        except Exception as e:
+            # Otherwise the parts that were not queued stay in progress.
+            db_session.query(ExportPart).filter(
+                    ExportPart.export_id == export_id,
+                    ExportPart.part >= part['part']
+                ).update({
+                    ExportPart.status: ExportPartStatus.ERROR,
+                    ExportPart.err_msg: 'Could not queue: {}'.format(e)
+                }, synchronize_session=False)
+            db_session.commit()
+            raise
+
+    return {'exportId': export_id}, 202
+
+
+def _export_part_to_dict(part):
+    return {
+        'part': part.part,
+        'rangeStart': part.start_index,
+        'rangeEnd': part.end_index,
+        'status': part.status.value,
+        'errMsg': part.err_msg,
+        'uri': part.uri,
+        'recordCount': part.record_count,
+        'sha256': part.sha256
+    }
+
+
+def get_export(project_id, export_id):
+    export = db_session.query(Export).filter(
+            Export.id == export_id,
+            Export.project_id == project_id
+        ).one_or_none()
+    if export is None:
+        _abort_with_msg("no such export '{}' in project '{}'".format(
+            export_id, project_id), 404)
+
+    parts = db_session.query(ExportPart).filter(
+            ExportPart.export_id == export_id
+        ).order_by(ExportPart.part).all()
+    statuses = {part.status for part in parts}
+    if ExportPartStatus.ERROR in statuses:
+        status = 'error'
+    elif ExportPartStatus.QUEUED in statuses:
+        status = 'in-progress'
+    else:
+        status = 'done'
+
+    return {
+        'exportId': export_id,
+        'projectId': project_id,
+        'status': status,
+        'format': {
+            'name': clk_export.FORMAT_NAME,
+            'version': clk_export.FORMAT_VERSION
+        },
+        'parts': [_export_part_to_dict(part) for part in parts]
+    }
+
+
 @flask_app.teardown_appcontext
 def shutdown_session(exception=None):
     db_session.remove()
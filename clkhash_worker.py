@@ -1,14 +1,28 @@
+import collections
+import concurrent.futures
+import hashlib
+import hmac
+import json
 import os
 
 import celery
 import celery.utils
 import clkhash
+import clkhash.field_formats
 import clkhash.validate_data
+import kombu
+import sqlalchemy.dialects.postgresql
 import sqlalchemy.exc
 import sqlalchemy.orm
 from clkhash.comparators import NonComparison
 
-from database import Clk, ClkStatus, db_session, Project
+import backlog
+import clk_export
+import pii_codec
+import task_client
+from config import env_bool, env_int
+from database import (ChunkMarker, Clk, ClkDigest, ClkStatus, db_session,
+                      Export, ExportPart, ExportPartStatus, Project)
 
 
 try:
@@ -17,16 +31,107 @@ except KeyError as _e:
     _msg = 'Unset environment variable CLKHASH_SERVICE_BROKER_URI.'
     raise KeyError(_msg) from _e
 
+# Where exports are written: file:///some/directory or s3://bucket/prefix.
+_EXPORT_URI = os.environ.get('CLKHASH_SERVICE_EXPORT_URI')
+# For S3-compatible stores other than AWS, e.g. MinIO.
+_EXPORT_S3_ENDPOINT = os.environ.get('CLKHASH_SERVICE_EXPORT_S3_ENDPOINT')
+
 
 app = celery.Celery(__name__, broker=_BROKER_URI)
+# Consume every priority queue; see task_client.PRIORITY_QUEUES.
+app.conf.task_queues = [kombu.Queue(name)
+                        for name in task_client.PRIORITY_QUEUES.values()]
+# Reserving few tasks per process lets newly queued high-priority
+# chunks be picked up by the next free process.
+app.conf.worker_prefetch_multiplier = env_int(
+    'CLKHASH_SERVICE_WORKER_PREFETCH_MULTIPLIER', 1)
+
+# Acknowledge tasks only once they finish, so that tasks of a lost
+# worker are redelivered. Safe since replays of completed chunks are
+# no-ops.
+ACKS_LATE = env_bool('CLKHASH_SERVICE_WORKER_ACKS_LATE', False)
+app.conf.task_acks_late = ACKS_LATE
+app.conf.task_reject_on_worker_lost = ACKS_LATE
+
+# If positive, a chunk is processed in batches of this many rows, with
+# the next batch read and the previous one written in background
+# threads while the current one is hashed.
+PIPELINE_BATCH_SIZE = env_int('CLKHASH_SERVICE_WORKER_PIPELINE_BATCH', 0)
+
 logger = celery.utils.log.get_task_logger(__name__)
 logger.info("Setting up celery worker...")
 
 
+class _DedupIndex:
+    """View of a project's deduplication index for one chunk of rows."""
+
+    def __init__(self, project_id, project_key, schema, records):
+        self.project_id = project_id
+        # Domain-separate from the key used for the Bloom filters.
+        self._key = hmac.new(project_key.encode('utf-8'),
+                             b'clkhash-service dedup',
+                             hashlib.sha256).digest()
+        self._fields = schema.fields
+        self._digests = {}
+        for r in records:
+            digest = self._digest(r.pii)
+            if digest is not None:
+                self._digests[r.index] = digest
+        self._known = dict(db_session.query(
+                ClkDigest.digest, ClkDigest.hash
+            ).filter(
+                ClkDigest.project_id == project_id,
+                ClkDigest.digest.in_(set(self._digests.values()))
+            ))
+        self._new = {}
+
+    def _digest(self, row):
+        """HMAC of all that the clk of `row` depends on: the formatted
+        values of its hashed columns. Columns that are only validated,
+        such as record IDs, are left out.
+
+        None if a value cannot be formatted; such rows are never hashed.
+        """
+        try:
+            values = [field.format_value(value)
+                      if field.hashing_properties is not None
+                      else None
+                      for value, field in zip(row, self._fields)]
+        except clkhash.field_formats.InvalidEntryError:
+            return None
+        normalised = json.dumps(values, ensure_ascii=False,
+                                separators=(',', ':'))
+        return hmac.new(self._key, normalised.encode('utf-8'),
+                        hashlib.sha256).digest()
+
+    def lookup(self, index):
+        """Return the known clk of the row at `index`, or None."""
+        digest = self._digests.get(index)
+        return self._known.get(digest) if digest is not None else None
+
+    def add(self, index, clk):
+        digest = self._digests.get(index)
+        if digest is None:
+            return
+        self._known[digest] = clk
+        self._new[digest] = clk
+
+    def flush(self):
+        """Add new digests to the index within the current transaction."""
+        if not self._new:
+            return
+        stmt = sqlalchemy.dialects.postgresql.insert(ClkDigest).values([
+                dict(project_id=self.project_id, digest=digest, hash=clk)
+                for digest, clk in self._new.items()
+            ]).on_conflict_do_nothing()
+        db_session.execute(stmt)
+        self._new.clear()
+
+
 def _get_mapping_for_hash(project_id, key_lists,
                           schema, comparators,
                           validate,
-                          r):
+                          r, dedup_index=None):
     try:
         if validate:
             clkhash.validate_data.validate_entries(schema.fields,
@@ -36,29 +141,164 @@ def _get_mapping_for_hash(project_id, key_lists,
         msg, *_ = e.args
         mapping = dict(
             project_id=project_id, index=r.index,
-            err_msg=msg, pii=None, status=ClkStatus.INVALID_DATA)
+            err_msg=msg, pii=None, pii_packed=None,
+            status=ClkStatus.INVALID_DATA)
     else:
-        bf, _, _ = clkhash.bloomfilter.crypto_bloom_filter(r.pii, comparators, schema, key_lists)
+        clk = dedup_index.lookup(r.index) if dedup_index is not None else None
+        if clk is None:
+            bf, _, _ = clkhash.bloomfilter.crypto_bloom_filter(r.pii, comparators, schema, key_lists)
+            clk = bf.tobytes()
+            if dedup_index is not None:
+                dedup_index.add(r.index, clk)
 
         mapping = dict(
             project_id=project_id, index=r.index,
-            hash=bf.tobytes(), pii=None, status=ClkStatus.DONE)
+            hash=clk, pii=None, pii_packed=None, status=ClkStatus.DONE)
 
     return mapping
 
 
-@app.task
+# A row of PII awaiting hashing.
+_Record = collections.namedtuple('_Record', ['index', 'pii'])
+
+
+def _load_records(project_id, project, schema, start_index, end_index):
+    """Read the PII of a range of clks, and their deduplication index.
+
+    Clks finished by an earlier delivery of the task are skipped.
+    """
+    clks = db_session.query(Clk).filter(
+        Clk.project_id == project_id,
+        Clk.index >= start_index,
+        Clk.index < end_index,
+        Clk.status.in_(backlog.OUTSTANDING_STATUSES)
+    ).options(
+        sqlalchemy.orm.load_only(Clk.index, Clk.pii, Clk.pii_packed)
+    ).order_by(Clk.index)
+    # Rows uploaded before PII was packed are still stored as JSON.
+    records = [_Record(clk.index,
+                       pii_codec.unpack(clk.pii_packed)
+                       if clk.pii_packed is not None
+                       else clk.pii)
+               for clk in clks]
+
+    dedup_index = (_DedupIndex(project_id, project.key, schema, records)
+                   if project.dedup
+                   else None)
+    return records, dedup_index
+
+
+def _hash_records(project_id, key_lists, schema, comparators, validate,
+                  records, dedup_index):
+    mappings = []
+    for r in records:
+        # Big try/except block, so we can resume hashing on other
+        # Clks even if we error.
+        mapping = None
+        try:
+            mapping = _get_mapping_for_hash(project_id, key_lists, schema, comparators, validate, r,
+                                            dedup_index)
+        except Exception as e:
+            logger.warning('Exception while hashing: {}'.format(e))
+            mapping = dict(
+                project_id=project_id, index=r.index,
+                err_msg=str(e), status=ClkStatus.ERROR,
+                pii=None, pii_packed=None)
+
+        assert mapping is not None
+        mappings.append(mapping)
+    return mappings
+
+
+def _write_mappings(project_id, mappings, dedup_index, marker=None):
+    """Write hashes and, for the last batch, the chunk's marker."""
+    # Clks first, then the project's counter last, in the same order
+    # as everywhere else so that concurrent writers cannot deadlock,
+    # and so that the project row is locked only briefly.
+    finished_count = backlog.lock_outstanding(
+        project_id, [mapping['index'] for mapping in mappings])
+    db_session.bulk_update_mappings(Clk, mappings)
+    if dedup_index is not None:
+        dedup_index.flush()
+    if mappings:
+        backlog.record_throughput(len(mappings))
+    if marker is not None:
+        db_session.execute(
+            sqlalchemy.dialects.postgresql.insert(ChunkMarker).values(
+                **marker
+            ).on_conflict_do_nothing())
+    if finished_count:
+        backlog.add_outstanding(project_id, -finished_count)
+    db_session.commit()
+    backlog.prune_throughput()
+
+
+def _in_own_session(function, *args):
+    """Call `function` and release the calling thread's session."""
+    try:
+        return function(*args)
+    finally:
+        db_session.remove()
+
+
+def _hash_pipelined(project, schema, start_index, end_index, hash_records,
+                    marker):
+    """Hash a range of clks in batches, overlapping I/O with hashing.
+
+    While batch N is hashed in this thread, batch N + 1 is read and
+    batch N - 1 written in I/O threads, each with its own session.
+    """
+    batch_starts = range(start_index, end_index, PIPELINE_BATCH_SIZE)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as io_pool:
+        def load(batch_start):
+            batch_end = min(batch_start + PIPELINE_BATCH_SIZE, end_index)
+            return io_pool.submit(_in_own_session, _load_records,
+                                  project.id, project, schema,
+                                  batch_start, batch_end)
+
+        next_load = load(batch_starts[0])
+        pending_write = None
+        found_records = False
+        for i in range(len(batch_starts)):
+            records, dedup_index = next_load.result()
+            if i + 1 < len(batch_starts):
+                next_load = load(batch_starts[i + 1])
+            found_records = found_records or bool(records)
+
+            mappings = hash_records(records, dedup_index)
+            is_last = i + 1 == len(batch_starts)
+
+            if pending_write is not None:
+                pending_write.result()  # At most one write in flight.
+            pending_write = io_pool.submit(
+                _in_own_session, _write_mappings,
+                project.id, mappings, dedup_index,
+                marker if is_last and found_records else None)
+
+        pending_write.result()
+
+
+@app.task(name=task_client.HASH_TASK)
 def hash(project_id, validate, start_index, end_index):
     try:
         logger.info('{}-{}: Starting.'.format(start_index, end_index))
+        if db_session.query(db_session.query(ChunkMarker).filter(
+                ChunkMarker.project_id == project_id,
+                ChunkMarker.start_index == start_index,
+                ChunkMarker.end_index == end_index).exists()).scalar():
+            logger.info('{}-{}: Already done. Exiting early.'.format(
+                start_index, end_index))
+            return
+
         # Mark clks as in process
         db_session.query(Clk).filter(
                 Clk.project_id == project_id,
                 Clk.index >= start_index,
-                Clk.index < end_index
+                Clk.index < end_index,
+                Clk.status == ClkStatus.QUEUED
             ).update({
                 Clk.status: ClkStatus.IN_PROGRESS
-            })
+            }, synchronize_session=False)
         db_session.commit()
 
         logger.debug("{}-{}: Marked as 'in-progress'.".format(
@@ -68,7 +308,9 @@ def hash(project_id, validate, start_index, end_index):
             project = db_session.query(Project).filter(
                     Project.id == project_id
                 ).options(
-                    sqlalchemy.orm.load_only(Project.schema, Project.key)
+                    sqlalchemy.orm.load_only(
+                        Project.id, Project.schema, Project.key,
+                        Project.dedup)
                 ).one()
         except sqlalchemy.orm.exc.NoResultFound:
             logger.info('{}-{}: Project deleted. Exiting early.'.format(
@@ -86,45 +328,131 @@ def hash(project_id, validate, start_index, end_index):
             kdf=schema.kdf_type,
             hash_algo=schema.kdf_hash)
 
-        records = db_session.query(Clk).filter(
-            Clk.project_id == project_id,
-            Clk.index >= start_index,
-            Clk.index < end_index)
-
         comparators = [field.hashing_properties.comparator
                        if field.hashing_properties is not None else NonComparison()
                        for field in schema.fields]
 
-        mappings = []
-        for r in records:
-            # Big try/except block, so we can resume hashing on other
-            # Clks even if we error.
-            mapping = None
-            try:
-                mapping = _get_mapping_for_hash(project_id, key_lists, schema, comparators, validate, r)
-            except Exception as e:
-                logger.warning('Exception while hashing: {}'.format(e))
-                mapping = dict(
-                    project_id=project_id, index=r.index,
-                    err_msg=str(e), status=ClkStatus.ERROR, pii=None)
-
-            assert mapping is not None
-            mappings.append(mapping)
-
-        db_session.bulk_update_mappings(Clk, mappings)
-        db_session.commit()
+        def hash_records(records, dedup_index):
+            return _hash_records(project_id, key_lists, schema, comparators,
+                                 validate, records, dedup_index)
+
+        # Only written if the task found clks to hash. It may have run
+        # before the upload committed, or be a leftover of a deleted
+        # project whose ID has been reused; either way, a later
+        # delivery must not skip the chunk.
+        marker = dict(project_id=project_id,
+                      start_index=start_index, end_index=end_index)
+
+        try:
+            if 0 < PIPELINE_BATCH_SIZE < end_index - start_index:
+                # The I/O threads need the project after our session
+                # ends.
+                db_session.expunge(project)
+                # Only the I/O threads use the database from here on, so
+                # release our connection rather than sit idle in a
+                # transaction.
+                db_session.close()
+                _hash_pipelined(project, schema, start_index, end_index,
+                                hash_records, marker)
+            else:
+                records, dedup_index = _load_records(
+                    project_id, project, schema, start_index, end_index)
+                mappings = hash_records(records, dedup_index)
+                _write_mappings(project_id, mappings, dedup_index,
+                                marker if records else None)
+        except (sqlalchemy.exc.IntegrityError,
+                sqlalchemy.orm.exc.StaleDataError):
+            # Writes fail once the project is deleted: its clks are
+            # gone, and the marker and deduplication index reference it.
+            db_session.rollback()
+            if db_session.query(Project.id).filter(
+                    Project.id == project_id).one_or_none() is not None:
+                raise
+            logger.info('{}-{}: Project deleted. Exiting early.'.format(
+                start_index, end_index))
+            return
 
     except BaseException as e:
-        logger.error('Fatal error: {}'.format(e))
-        db_session.query(Clk).filter(
+        db_session.rollback()
+        # Never touch clks that are already finished.
+        outstanding = db_session.query(Clk).filter(
                 Clk.project_id == project_id,
                 Clk.index >= start_index,
-                Clk.index < end_index
-            ).update({
+                Clk.index < end_index,
+                Clk.status.in_(backlog.OUTSTANDING_STATUSES)
+            )
+        if ACKS_LATE and not isinstance(e, Exception):
+            # Interrupted, e.g. by shutdown: the task will be redelivered.
+            logger.warning('Interrupted: {!r}'.format(e))
+            outstanding.update({
+                Clk.status: ClkStatus.QUEUED
+            }, synchronize_session=False)
+        else:
+            logger.error('Fatal error: {}'.format(e))
+            failed_count = outstanding.update({
                 Clk.hash: None,
                 Clk.pii: None,
+                Clk.pii_packed: None,
                 Clk.status: ClkStatus.ERROR,
                 Clk.err_msg: "Fatal error: {}".format(e)
+            }, synchronize_session=False)
+            backlog.add_outstanding(project_id, -failed_count)
+        db_session.commit()
+        raise
+
+
+@app.task(name=task_client.EXPORT_PART_TASK)
+def export_part(export_id, part):
+    part_row = db_session.query(ExportPart).filter(
+            ExportPart.export_id == export_id,
+            ExportPart.part == part
+        ).one_or_none()
+    if part_row is None:
+        logger.info('Export {} part {}: Export deleted. Exiting early.'.format(
+            export_id, part))
+        return
+
+    try:
+        if _EXPORT_URI is None:
+            raise KeyError(
+                'Unset environment variable CLKHASH_SERVICE_EXPORT_URI.')
+
+        project_id = db_session.query(Export.project_id).filter(
+                Export.id == export_id
+            ).scalar()
+        clks = db_session.query(Clk.index, Clk.hash).filter(
+                Clk.project_id == project_id,
+                Clk.index >= part_row.start_index,
+                Clk.index < part_row.end_index,
+                Clk.status == ClkStatus.DONE
+            ).order_by(Clk.index).all()
+
+        data = clk_export.encode_part(clks)
+        # Keyed by the export ID alone: project IDs are arbitrary
+        # strings, which could name paths outside the sink.
+        key = '{}/part-{:05d}.{}'.format(export_id, part,
+                                         clk_export.FORMAT_NAME)
+        sink = clk_export.sink_from_uri(_EXPORT_URI, _EXPORT_S3_ENDPOINT)
+        uri = sink.write(key, data)
+
+        part_row.status = ExportPartStatus.DONE
+        part_row.uri = uri
+        part_row.record_count = len(clks)
+        part_row.sha256 = hashlib.sha256(data).hexdigest()
+        db_session.commit()
+        logger.info('Export {} part {}: Wrote {} clks to {}.'.format(
+            export_id, part, len(clks), uri))
+
+    except BaseException as e:
+        logger.error('Export {} part {}: Fatal error: {}'.format(
+            export_id, part, e))
+        db_session.rollback()
+        db_session.query(ExportPart).filter(
+                ExportPart.export_id == export_id,
+                ExportPart.part == part
+            ).update({
+                ExportPart.status: ExportPartStatus.ERROR,
+                ExportPart.err_msg: 'Fatal error: {}'.format(e)
             })
         db_session.commit()
         raise
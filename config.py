@@ -0,0 +1,21 @@
+import os
+
+
+def env_int(name, default):
+    """Read an integer from environment variable `name`."""
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError as e:
+        msg = 'Environment variable {} must be an integer.'.format(name)
+        raise ValueError(msg) from e
+
+
+def env_bool(name, default):
+    """Read a boolean from environment variable `name`."""
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return default
+    return value.lower() in {'1', 'true', 'yes', 'on'}
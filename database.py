@@ -1,24 +1,75 @@
 import enum
+import functools
 import os
 import sys
+import uuid
 
-from sqlalchemy import (Column, create_engine, Enum, ForeignKey,
-                        Integer, JSON, LargeBinary, String)
-from sqlalchemy.orm import relationship, scoped_session, sessionmaker
+from sqlalchemy import (Boolean, Column, create_engine, DateTime, Enum,
+                        false, ForeignKey, func, Integer, JSON,
+                        LargeBinary, String)
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import relationship, scoped_session, Session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-
-
-try:
-    _DB_URI = os.environ['CLKHASH_SERVICE_DB_URI']
-except KeyError as _e:
-    _msg = 'Unset environment variable CLKHASH_SERVICE_DB_URI.'
-    raise KeyError(_msg) from _e
-
-
-engine = create_engine(_DB_URI)
-db_session = scoped_session(sessionmaker(autocommit=False,
-                                         autoflush=False,
-                                         bind=engine))
+from sqlalchemy.pool import NullPool, QueuePool
+
+from config import env_bool, env_int
+
+
+# Set when connecting through a transaction-pooling proxy (pgbouncer).
+TRANSACTION_POOLING = env_bool('CLKHASH_SERVICE_DB_TRANSACTION_POOLING',
+                               False)
+
+
+def _engine_options(db_uri):
+    """Keyword arguments for `create_engine` from the environment.
+
+    In transaction-pooling mode (e.g. behind pgbouncer) we leave the
+    pooling to the bouncer. Consecutive transactions may land on
+    different backends, so we must not rely on per-connection server
+    state: psycopg2 does not prepare statements server-side and we
+    never use named cursors, so disabling our own pool is sufficient.
+    """
+    if TRANSACTION_POOLING:
+        return {'poolclass': NullPool}
+
+    options = {
+        # -1 disables recycling.
+        'pool_recycle': env_int('CLKHASH_SERVICE_DB_POOL_RECYCLE', -1),
+        'pool_pre_ping': env_bool('CLKHASH_SERVICE_DB_POOL_PRE_PING', False),
+    }
+    # Only a QueuePool has a size. Other dialects, such as SQLite,
+    # default to pools that reject these arguments.
+    url = make_url(db_uri)
+    if issubclass(url.get_dialect().get_pool_class(url), QueuePool):
+        options.update({
+            'pool_size': env_int('CLKHASH_SERVICE_DB_POOL_SIZE', 5),
+            'max_overflow': env_int('CLKHASH_SERVICE_DB_MAX_OVERFLOW', 10),
+            'pool_timeout': env_int('CLKHASH_SERVICE_DB_POOL_TIMEOUT', 30),
+        })
+    return options
+
+
+@functools.lru_cache(maxsize=None)
+def get_engine():
+    """Return the engine, creating it on first use."""
+    try:
+        db_uri = os.environ['CLKHASH_SERVICE_DB_URI']
+    except KeyError as e:
+        msg = 'Unset environment variable CLKHASH_SERVICE_DB_URI.'
+        raise KeyError(msg) from e
+    return create_engine(db_uri, **_engine_options(db_uri))
+
+
+class _LazyEngineSession(Session):
+    """Session that creates the engine only when it first needs it."""
+
+    def get_bind(self, *args, **kwargs):
+        return get_engine()
+
+
+db_session = scoped_session(sessionmaker(class_=_LazyEngineSession,
+                                         autocommit=False,
+                                         autoflush=False))
 Base = declarative_base()
 
 
@@ -37,6 +88,12 @@ class Project(Base):
     schema = Column(JSON, nullable=False)
     key = Column(String, nullable=False)
     clk_count = Column(Integer, nullable=False, server_default='0')
+    dedup = Column(Boolean, nullable=False, server_default=false())
+    # Distinguishes a project from earlier ones with the same ID.
+    generation = Column(String, default=lambda: uuid.uuid4().hex)
+    # Clks queued or in progress. Kept up to date by the app and the
+    # workers so the backlog can be read without counting clks.
+    outstanding_count = Column(Integer, nullable=False, server_default='0')
 
 
 class Clk(Base):
@@ -47,11 +104,84 @@ class Clk(Base):
     status = Column(Enum(ClkStatus), nullable=False)
     err_msg = Column(String)
     pii = Column(JSON)  # Future: make own table if having scale issues?
+    # Columns needed for hashing, packed by pii_codec. Replaces `pii`.
+    pii_packed = Column(LargeBinary)
     hash = Column(LargeBinary)
 
 
+class ClkDigest(Base):
+    """Deduplication index: clk of each distinct row hashed so far.
+
+    The digest is an HMAC of the hashed columns of the row, as
+    formatted for hashing, under a key derived from the project key, so
+    no PII is stored.
+    """
+    __tablename__ = 'clk_digests'
+
+    project_id = Column(String, ForeignKey(Project.id, ondelete="CASCADE"), primary_key=True)
+    digest = Column(LargeBinary, primary_key=True)
+    hash = Column(LargeBinary, nullable=False)
+
+
+class ChunkMarker(Base):
+    """Records that the hashing task of a chunk has completed.
+
+    Written in the same transaction as the last of the chunk's hashes,
+    so a redelivered task can tell that there is nothing left to do.
+    Keyed by the whole range, so that a stale task of a deleted project
+    with the same ID cannot mark a different chunk as done.
+    """
+    __tablename__ = 'chunk_markers'
+
+    project_id = Column(String, ForeignKey(Project.id, ondelete="CASCADE"), primary_key=True)
+    start_index = Column(Integer, primary_key=True)
+    end_index = Column(Integer, primary_key=True)
+    completed_at = Column(DateTime, nullable=False,
+                          server_default=func.timezone('UTC', func.now()))
+
+
+class ExportPartStatus(enum.Enum):
+    QUEUED = 'queued'
+    DONE = 'done'
+    ERROR = 'error'
+
+
+class Export(Base):
+    __tablename__ = 'exports'
+
+    id = Column(String, primary_key=True)
+    project_id = Column(String, ForeignKey(Project.id, ondelete="CASCADE"), nullable=False)
+    created_at = Column(DateTime, nullable=False,
+                        server_default=func.timezone('UTC', func.now()))
+
+
+class ExportPart(Base):
+    """A range of clk indices exported to one file by one worker task."""
+    __tablename__ = 'export_parts'
+
+    export_id = Column(String, ForeignKey(Export.id, ondelete="CASCADE"), primary_key=True)
+    part = Column(Integer, primary_key=True)
+    start_index = Column(Integer, nullable=False)
+    end_index = Column(Integer, nullable=False)
+    status = Column(Enum(ExportPartStatus), nullable=False)
+    err_msg = Column(String)
+    uri = Column(String)
+    record_count = Column(Integer)
+    sha256 = Column(String)
+
+
+class ThroughputSample(Base):
+    """Number of rows hashed by a worker task, and when it finished."""
+    __tablename__ = 'throughput_samples'
+
+    id = Column(Integer, primary_key=True)
+    finished_at = Column(DateTime, nullable=False, index=True,
+                         server_default=func.timezone('UTC', func.now()))
+    row_count = Column(Integer, nullable=False)
+
+
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    Base.metadata.create_all(bind=get_engine())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,182 @@
+import fcntl
+import glob
+import mmap
+import os
+import struct
+import threading
+import time
+import urllib.parse
+
+
+# A store file starts with a header holding the hash size. Record `i`
+# follows at a fixed offset: a byte that is 1 once the record is
+# written, then the hash. Unwritten records are holes in a sparse file.
+_MAGIC = b'CLKS'
+_HEADER = struct.Struct('<4sI')  # magic, hash size
+_PRESENT = b'\x01'
+
+# Files are evicted least recently used first. Reads mark a file used
+# at most this often, in seconds, to keep them free of writes.
+_TOUCH_INTERVAL = 60
+
+
+class HashStore:
+    """Local copy of finished hashes in per-project memory-mapped files.
+
+    The database remains the source of truth: the store only holds the
+    hashes of clks that are done, which never change. Files are named
+    after the project generation, so a deleted and recreated project
+    never sees the hashes of its predecessor.
+
+    If `max_bytes` is given, the least recently used files are deleted
+    whenever the files take up more disk space than that.
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._maps = {}  # path -> (mmap, hash size, inode)
+        self._touched = {}  # path -> when it was last marked as used
+
+    def _prefix(self, project_id):
+        return os.path.join(self.directory,
+                            urllib.parse.quote(project_id, safe=''))
+
+    def _path(self, project_id, generation):
+        return '{}.{}.clks'.format(self._prefix(project_id), generation)
+
+    def _map(self, path):
+        """Return `(mmap, hash_size)` for the file at `path`, or None.
+
+        Remaps the file if it has grown or been replaced since it was
+        last mapped. Old maps are not closed since responses may still
+        hold slices.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if stat.st_size < _HEADER.size:
+            return None
+
+        with self._lock:
+            entry = self._maps.get(path)
+            if (entry is None
+                    or entry[2] != stat.st_ino
+                    or len(entry[0]) < stat.st_size):
+                with open(path, 'rb') as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                magic, hash_size = _HEADER.unpack_from(mapped)
+                if magic != _MAGIC:
+                    return None
+                entry = self._maps[path] = mapped, hash_size, stat.st_ino
+            mapped, hash_size, _ = entry
+            return mapped, hash_size
+
+    def _touch(self, path):
+        """Mark the file at `path` as recently used."""
+        now = time.time()
+        with self._lock:
+            if now - self._touched.get(path, 0) < _TOUCH_INTERVAL:
+                return
+            self._touched[path] = now
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def _remove(self, path):
+        with self._lock:
+            self._maps.pop(path, None)
+            self._touched.pop(path, None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, keep):
+        """Delete least recently used files other than `keep` until
+        the store fits in `max_bytes`.
+        """
+        files = []
+        for path in glob.glob(os.path.join(glob.escape(self.directory),
+                                           '*.clks')):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            # Files are sparse, so count the blocks actually used.
+            files.append((stat.st_mtime, stat.st_blocks * 512, path))
+
+        used = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if used <= self.max_bytes:
+                break
+            if path != keep:
+                self._remove(path)
+                used -= size
+
+    def get_many(self, project_id, generation, indices):
+        """Return a dict from index to hash for the stored `indices`.
+
+        The hashes are memoryviews of the mapped file.
+        """
+        path = self._path(project_id, generation)
+        entry = self._map(path)
+        if entry is None:
+            return {}
+        self._touch(path)
+        mapped, hash_size = entry
+        view = memoryview(mapped)
+        record_size = 1 + hash_size
+
+        hashes = {}
+        for index in indices:
+            offset = _HEADER.size + index * record_size
+            if (offset + record_size <= len(mapped)
+                    and mapped[offset] == _PRESENT[0]):
+                hashes[index] = view[offset + 1:offset + record_size]
+        return hashes
+
+    def put_many(self, project_id, generation, hashes):
+        """Store `(index, hash)` pairs of finished clks."""
+        if not hashes:
+            return
+        path = self._path(project_id, generation)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # Other processes may share the directory.
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            header = os.pread(fd, _HEADER.size, 0)
+            if len(header) < _HEADER.size:
+                _, first_hash = hashes[0]
+                hash_size = len(first_hash)
+                os.pwrite(fd, _HEADER.pack(_MAGIC, hash_size), 0)
+            else:
+                _, hash_size = _HEADER.unpack(header)
+            record_size = 1 + hash_size
+
+            for index, hash_ in hashes:
+                if len(hash_) != hash_size:
+                    continue
+                offset = _HEADER.size + index * record_size
+                # Write the hash before marking it present, so readers
+                # never see a partial record.
+                os.pwrite(fd, hash_, offset + 1)
+                os.pwrite(fd, _PRESENT, offset)
+        finally:
+            os.close(fd)
+
+        if self.max_bytes is not None:
+            self._evict(keep=path)
+
+    def drop(self, project_id):
+        """Delete the files of every generation of `project_id`."""
+        prefix = self._prefix(project_id)
+        for path in glob.glob(glob.escape(prefix) + '.*.clks'):
+            generation = path[len(prefix) + 1:-len('.clks')]
+            if '.' in generation:  # Belongs to another project.
+                continue
+            self._remove(path)
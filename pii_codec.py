@@ -0,0 +1,70 @@
+import struct
+
+
+# A packed row starts with the number of columns, then a bitmap with a
+# bit set for every column that is stored. Each stored column follows
+# as a varint byte length and its UTF-8 encoding. Columns that are not
+# stored unpack as empty strings.
+_ROW_LENGTH = struct.Struct('<H')
+
+# Rows with more columns than this cannot be packed.
+MAX_COLUMNS = 0xffff
+
+
+def _encode_varint(value):
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append(value & 0x7f | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return encoded
+
+
+def _decode_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def pack(row, keep):
+    """Pack the columns of `row` for which `keep` is true.
+
+    Columns beyond the length of `keep` are dropped, but still counted,
+    so that the row unpacks to its original length.
+    """
+    row_length = len(row)
+    if row_length > MAX_COLUMNS:
+        raise ValueError('cannot pack more than {} columns'.format(
+            MAX_COLUMNS))
+    bitmap = bytearray((row_length + 7) // 8)
+    values = bytearray()
+    for i in range(row_length):
+        if i < len(keep) and keep[i]:
+            bitmap[i >> 3] |= 1 << (i & 7)
+            value = row[i].encode('utf-8')
+            values += _encode_varint(len(value))
+            values += value
+    return _ROW_LENGTH.pack(row_length) + bytes(bitmap) + bytes(values)
+
+
+def unpack(packed):
+    """Inverse of `pack`, with empty strings for dropped columns."""
+    row_length, = _ROW_LENGTH.unpack_from(packed)
+    offset = _ROW_LENGTH.size
+    bitmap = packed[offset:offset + (row_length + 7) // 8]
+    offset += len(bitmap)
+
+    row = []
+    for i in range(row_length):
+        if bitmap[i >> 3] & (1 << (i & 7)):
+            length, offset = _decode_varint(packed, offset)
+            row.append(packed[offset:offset + length].decode('utf-8'))
+            offset += length
+        else:
+            row.append('')
+    return row
@@ -0,0 +1,121 @@
+import collections
+import logging
+import select
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Postgres channel on which deleted project IDs are announced.
+INVALIDATION_CHANNEL = 'clkhash_service_project_invalidation'
+
+ProjectMetadata = collections.namedtuple(
+    'ProjectMetadata', ['schema_dict', 'schema', 'generation'])
+
+
+class ProjectCache:
+    """Thread-safe LRU cache with entries expiring after `ttl` seconds.
+
+    Only existing projects are cached, so a project created on another
+    replica is never hidden by a stale entry. A `maxsize` of 0 disables
+    the cache.
+    """
+
+    def __init__(self, maxsize, ttl, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, project_id):
+        """Return the cached value for `project_id`, or None."""
+        with self._lock:
+            try:
+                expiry, value = self._entries[project_id]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expiry <= self._clock():
+                del self._entries[project_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(project_id)
+            self.hits += 1
+            return value
+
+    def put(self, project_id, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[project_id] = self._clock() + self.ttl, value
+            self._entries.move_to_end(project_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, project_id):
+        with self._lock:
+            self._entries.pop(project_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._entries)}
+
+
+def _listen_for_invalidations(engine, on_invalidate, on_reset,
+                              poll_timeout, retry_delay):
+    while True:
+        try:
+            connection = engine.raw_connection()
+            connection.detach()  # Never return this one to the pool.
+            try:
+                dbapi_connection = connection.connection
+                dbapi_connection.autocommit = True
+                with dbapi_connection.cursor() as cursor:
+                    cursor.execute('LISTEN {}'.format(INVALIDATION_CHANNEL))
+                # We may have missed notifications while disconnected.
+                on_reset()
+
+                while True:
+                    readable, _, _ = select.select(
+                        [dbapi_connection], [], [], poll_timeout)
+                    if not readable:
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        notify = dbapi_connection.notifies.pop(0)
+                        on_invalidate(notify.payload)
+            finally:
+                connection.close()
+        except Exception as e:
+            logger.warning(
+                'Project cache invalidation listener failed: {}'.format(e))
+            on_reset()
+            time.sleep(retry_delay)
+
+
+def start_invalidation_listener(engine, on_invalidate, on_reset,
+                                poll_timeout=5, retry_delay=5):
+    """Call `on_invalidate` with project IDs announced by other replicas.
+
+    `on_reset` is called whenever notifications may have been missed.
+    Runs in a daemon thread holding one dedicated connection. Requires
+    Postgres and a session-mode connection: LISTEN does not work
+    through a transaction-pooling proxy, where only the TTL applies.
+    """
+    thread = threading.Thread(
+        target=_listen_for_invalidations,
+        args=(engine, on_invalidate, on_reset, poll_timeout, retry_delay),
+        name='project-cache-invalidation',
+        daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,41 @@
+import functools
+import os
+
+
+# Hashing tasks are routed by priority. Workers consume all queues in
+# turn, so chunks of small interactive uploads are not stuck behind
+# every chunk of a large upload.
+PRIORITY_QUEUES = {
+    'high': 'clkhash-high',
+    'normal': 'celery',  # Celery's default queue.
+    'low': 'clkhash-low',
+}
+
+# Names under which the worker registers its tasks. The app sends tasks
+# by name so that it does not need to import the worker.
+HASH_TASK = 'clkhash_worker.hash'
+EXPORT_PART_TASK = 'clkhash_worker.export_part'
+
+
+@functools.lru_cache(maxsize=None)
+def _client():
+    """Celery app used only to send tasks; created on first use."""
+    import celery
+
+    try:
+        broker_uri = os.environ['CLKHASH_SERVICE_BROKER_URI']
+    except KeyError as e:
+        msg = 'Unset environment variable CLKHASH_SERVICE_BROKER_URI.'
+        raise KeyError(msg) from e
+    return celery.Celery('clkhash_service', broker=broker_uri)
+
+
+def send_hash(project_id, validate, start_index, end_index, queue):
+    _client().send_task(HASH_TASK,
+                        args=(project_id, validate, start_index, end_index),
+                        queue=queue)
+
+
+def send_export_part(export_id, part, queue):
+    _client().send_task(EXPORT_PART_TASK, args=(export_id, part),
+                        queue=queue)
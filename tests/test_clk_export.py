@@ -0,0 +1,42 @@
+import os
+import tempfile
+import unittest
+
+import clk_export
+
+
+class TestPartFormat(unittest.TestCase):
+    def test_round_trip(self):
+        clks = [(0, b'\x00' * 128), (1, b'\xff' * 128), (7, bytes(range(128)))]
+        data = clk_export.encode_part(clks)
+        self.assertEqual(clk_export.decode_part(data), clks)
+
+    def test_empty(self):
+        data = clk_export.encode_part([])
+        self.assertEqual(clk_export.decode_part(data), [])
+
+    def test_mixed_hash_sizes(self):
+        with self.assertRaises(ValueError):
+            clk_export.encode_part([(0, b'\x00' * 128), (1, b'\x00' * 64)])
+
+    def test_not_a_part(self):
+        data = clk_export.encode_part([(0, b'\x00' * 128)])
+        with self.assertRaises(ValueError):
+            clk_export.decode_part(b'JUNK' + data[4:])
+
+
+class TestLocalSink(unittest.TestCase):
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as directory:
+            sink = clk_export.sink_from_uri('file://' + directory)
+            uri = sink.write('export/part-00000.clkx', b'data')
+            path = os.path.join(directory, 'export', 'part-00000.clkx')
+            self.assertEqual(uri, 'file://' + path)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'data')
+
+    def test_key_outside_sink(self):
+        with tempfile.TemporaryDirectory() as directory:
+            sink = clk_export.LocalSink(os.path.join(directory, 'exports'))
+            with self.assertRaises(ValueError):
+                sink.write('../part-00000.clkx', b'data')
@@ -4,8 +4,15 @@ import time
 import unittest
 
 import requests
+import sqlalchemy
 
 PREFIX = os.getenv('CLKHASH_SERVICE_PREFIX', 'http://0.0.0.0:8000')
+# The service's database, for tests that check its internal state. They
+# are skipped when this is unset.
+DB_URI = os.getenv('CLKHASH_SERVICE_DB_URI')
+# Must match the configuration of the service under test.
+MAX_OUTSTANDING_ROWS_PER_PROJECT = int(os.getenv(
+    'CLKHASH_SERVICE_MAX_OUTSTANDING_ROWS_PER_PROJECT', '2000'))
 
 PROJECT_ID = 'test-data'
 KEY = b'correct horse staple battery'
@@ -69,6 +76,62 @@ SCHEMA = {
 }
 
 
+# SCHEMA with columns that are not hashed.
+WIDE_SCHEMA = dict(SCHEMA, features=[
+    SCHEMA['features'][0],
+    {'identifier': 'NOTES', 'ignored': True},
+    *SCHEMA['features'][1:],
+    {'identifier': 'ID', 'ignored': True}
+])
+
+# WIDE_SCHEMA with a hashed integer column, which is normalised before
+# hashing, instead of the ID.
+AGE_SCHEMA = dict(WIDE_SCHEMA, features=[
+    *WIDE_SCHEMA['features'][:-1],
+    {
+        'identifier': 'AGE',
+        'format': {
+            'type': 'integer'
+        },
+        'hashing': {
+            'ngram': 1,
+            'positional': True
+        }
+    }
+])
+
+
+def _wait_until_hashed(project_id, timeout=30):
+    """Wait until no clk of the project is queued or in progress."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        r = requests.get(
+            PREFIX + '/projects/{}/clks/status'.format(project_id))
+        statuses = {group['status'] for group in r.json()['clksStatus']}
+        if not statuses & {'queued', 'in-progress'}:
+            return
+        time.sleep(0.5)
+
+
+def _execute(sql, **params):
+    """Run `sql` on the service's database and return the rows, if any."""
+    engine = sqlalchemy.create_engine(DB_URI)
+    try:
+        with engine.begin() as connection:
+            result = connection.execute(sqlalchemy.text(sql), params)
+            return result.fetchall() if result.returns_rows else None
+    finally:
+        engine.dispose()
+
+
+def _count_rows(table, project_id):
+    """Number of rows of `project_id` in a table of the service's database."""
+    [(count,)] = _execute(
+        'SELECT count(*) FROM {} WHERE project_id = :project_id'.format(table),
+        project_id=project_id)
+    return count
+
+
 class TestProjects(unittest.TestCase):
     def setUp(self):
         requests.delete(PREFIX + '/projects/{}'.format(PROJECT_ID))
@@ -169,6 +232,37 @@ class TestProjects(unittest.TestCase):
             r.status_code, 404,
             msg='Expected DELETE /projects/{} to fail.'.format(PROJECT_ID))
     
+    def test_project_cache_stats(self):
+        r = requests.post(
+            PREFIX + '/projects/',
+            params=dict(
+                project_id=PROJECT_ID,
+                secret_key=base64.b64encode(KEY)),
+            json=SCHEMA)
+        self.assertEqual(
+            r.status_code, 201,
+            msg='Expected POST /projects/ to succeed.')
+
+        r = requests.get(PREFIX + '/stats')
+        self.assertEqual(r.status_code, 200,
+                         msg='Expected GET /stats to succeed.')
+        hits = r.json()['projectCache']['hits']
+
+        # The second lookup is served from the cache.
+        for _ in range(2):
+            r = requests.get(PREFIX + '/projects/{}'.format(PROJECT_ID))
+            self.assertEqual(
+                r.status_code, 200,
+                msg='Expected GET /projects/{} to succeed.'.format(
+                    PROJECT_ID))
+
+        r = requests.get(PREFIX + '/stats')
+        self.assertEqual(r.status_code, 200,
+                         msg='Expected GET /stats to succeed.')
+        self.assertGreater(
+            r.json()['projectCache']['hits'], hits,
+            msg='Expected a project cache hit.')
+
     def tearDown(self):
         requests.delete(PREFIX + '/projects/{}'.format(PROJECT_ID))
 
@@ -270,6 +364,23 @@ class TestClks(unittest.TestCase):
             msg='Unexpected output from GET /projects/{}/clks/status'.format(
                 PROJECT_ID))
 
+        # The status can be restricted to a range.
+        r = requests.get(
+            PREFIX + '/projects/{}/clks/status'.format(PROJECT_ID),
+            params=dict(index_range_start=1,
+                        index_range_end=2))
+        self.assertEqual(
+            r.status_code, 200,
+            msg='Expected GET /projects/{}/clks/status to succeed.'.format(
+                PROJECT_ID))
+        clks_status = r.json()['clksStatus']
+        self.assertEqual(
+            [(group['rangeStart'], group['rangeEnd'])
+             for group in clks_status],
+            [(1, 2)],
+            msg='Unexpected output from GET /projects/{}/clks/status'.format(
+                PROJECT_ID))
+
         # Wait a second for clks to get processed
         time.sleep(0.5)
 
@@ -347,6 +458,458 @@ class TestClks(unittest.TestCase):
             msg='Expected DELETE /projects/{}/clks/ to fail.'.format(
                 PROJECT_ID))
 
-    
+    def test_unused_columns(self):
+        r = requests.post(
+            PREFIX + '/projects/',
+            params=dict(
+                project_id=PROJECT_ID,
+                secret_key=base64.b64encode(KEY)),
+            json=WIDE_SCHEMA)
+        self.assertEqual(
+            r.status_code, 201,
+            msg='Expected POST /projects/ to succeed.')
+
+        # Columns that are not hashed are not stored either, whether or
+        # not the data is validated. That must not change the hashes.
+        data = ('Jane Doe,likes cats,1968/05/19,F,1\n'
+                'Peter Griffin,,1998/12/20,M,2\n')
+        for validate in ['false', 'true']:
+            r = requests.post(
+                PREFIX + '/projects/{}/pii/'.format(PROJECT_ID),
+                params=dict(header='false', validate=validate),
+                data=data)
+            self.assertEqual(
+                r.status_code, 202,
+                msg='Expected POST /projects/{}/pii/ to succeed.'.format(
+                    PROJECT_ID))
+
+        _wait_until_hashed(PROJECT_ID)
+
+        r = requests.get(
+            PREFIX + '/projects/{}/clks/'.format(PROJECT_ID))
+        self.assertEqual(
+            r.status_code, 200,
+            msg='Expected GET /projects/{}/clks/ to succeed.'.format(
+                PROJECT_ID))
+        clks = r.json()['clks']
+        self.assertEqual(
+            [clk['status'] for clk in clks], ['done'] * 4,
+            msg='Unexpected output from GET /projects/{}/clks/'.format(
+                PROJECT_ID))
+        hashes = [clk['hash'] for clk in clks]
+        self.assertEqual(
+            hashes[:2], hashes[2:],
+            msg='Expected the same hashes with and without validation.')
+        self.assertNotEqual(
+            hashes[0], hashes[1],
+            msg='Expected different rows to have different hashes.')
+
+    def test_repeated_downloads(self):
+        # The service under test keeps a local copy of finished hashes,
+        # so the second download is served from it.
+        r = requests.post(
+            PREFIX + '/projects/',
+            params=dict(
+                project_id=PROJECT_ID,
+                secret_key=base64.b64encode(KEY)),
+            json=SCHEMA)
+        self.assertEqual(
+            r.status_code, 201,
+            msg='Expected POST /projects/ to succeed.')
+
+        r = requests.post(
+            PREFIX + '/projects/{}/pii/'.format(PROJECT_ID),
+            params=dict(header='false'),
+            data='Jane Doe,1968/05/19,F\n'
+                 'Peter Griffin,1998/12/20,M\n'
+                 'Jane Doe,1968/05/19,X\n')
+        self.assertEqual(
+            r.status_code, 202,
+            msg='Expected POST /projects/{}/pii/ to succeed.'.format(
+                PROJECT_ID))
+
+        _wait_until_hashed(PROJECT_ID)
+
+        downloads = []
+        for _ in range(2):
+            r = requests.get(
+                PREFIX + '/projects/{}/clks/'.format(PROJECT_ID))
+            self.assertEqual(
+                r.status_code, 200,
+                msg='Expected GET /projects/{}/clks/ to succeed.'.format(
+                    PROJECT_ID))
+            downloads.append(r.json())
+        self.assertEqual(
+            [clk['status'] for clk in downloads[0]['clks']],
+            ['done', 'done', 'invalid-data'],
+            msg='Unexpected output from GET /projects/{}/clks/'.format(
+                PROJECT_ID))
+        self.assertEqual(
+            downloads[0], downloads[1],
+            msg='Expected repeated downloads to be identical.')
+
+        # Pages are served from the local copy too.
+        r = requests.get(
+            PREFIX + '/projects/{}/clks/'.format(PROJECT_ID),
+            params=dict(page_limit=1, cursor='0'))
+        self.assertEqual(
+            r.status_code, 200,
+            msg='Expected GET /projects/{}/clks/ to succeed.'.format(
+                PROJECT_ID))
+        self.assertEqual(
+            r.json()['clks'], downloads[0]['clks'][1:2],
+            msg='Unexpected output from GET /projects/{}/clks/'.format(
+                PROJECT_ID))
+
+    def test_priority(self):
+        r = requests.post(
+            PREFIX + '/projects/',
+            params=dict(
+                project_id=PROJECT_ID,
+                secret_key=base64.b64encode(KEY)),
+            json=SCHEMA)
+        self.assertEqual(
+            r.status_code, 201,
+            msg='Expected POST /projects/ to succeed.')
+
+        for priority in ['high', 'normal', 'low']:
+            r = requests.post(
+                PREFIX + '/projects/{}/pii/'.format(PROJECT_ID),
+                params=dict(header='false', priority=priority),
+                data='Jane Doe,1968/05/19,F\n')
+            self.assertEqual(
+                r.status_code, 202,
+                msg='Expected POST /projects/{}/pii/ to succeed.'.format(
+                    PROJECT_ID))
+
+        r = requests.post(
+            PREFIX + '/projects/{}/pii/'.format(PROJECT_ID),
+            params=dict(header='false', priority='urgent'),
+            data='Jane Doe,1968/05/19,F\n')
+        self.assertEqual(
+            r.status_code, 400,
+            msg='Expected POST /projects/{}/pii/ to fail.'.format(
+                PROJECT_ID))
+
+        # Every priority is hashed.
+        _wait_until_hashed(PROJECT_ID)
+        r = requests.get(
+            PREFIX + '/projects/{}/clks/'.format(PROJECT_ID),
+            params=dict(status='done'))
+        self.assertEqual(
+            r.status_code, 200,
+            msg='Expected GET /projects/{}/clks/ to succeed.'.format(
+                PROJECT_ID))
+        self.assertEqual(
+            len(r.json()['clks']), 3,
+            msg='Unexpected output from GET /projects/{}/clks/'.format(
+                PROJECT_ID))
+
+    def test_backlog(self):
+        r = requests.get(PREFIX + '/backlog')
+        self.assertEqual(r.status_code, 200,
+                         msg='Expected GET /backlog to succeed.')
+        backlog = r.json()
+        self.assertGreaterEqual(
+            backlog['outstandingRows'], 0,
+            msg='Unexpected output from GET /backlog.')
+        self.assertGreaterEqual(
+            backlog['throughputRowsPerSecond'], 0,
+            msg='Unexpected output from GET /backlog.')
+
+    def test_backlog_limits(self):
+        row = 'Jane Doe,1968/05/19,F\n'
+        limit = MAX_OUTSTANDING_ROWS_PER_PROJECT
+
+        # The project doesn't exist yet, whatever the size of the upload.
+        r = requests.post(
+            PREFIX + '/projects/{}/pii/'.format(PROJECT_ID),
+            params=dict(header='false'),
+            data=row * (limit + 1))
+        self.assertEqual(
+            r.status_code, 404,
+            msg='Expected POST /projects/{}/pii/ to fail.'.format(
+                PROJECT_ID))
+
+        r = requests.post(
+            PREFIX + '/projects/',
+            params=dict(
+                project_id=PROJECT_ID,
+                secret_key=base64.b64encode(KEY)),
+            json=SCHEMA)
+        self.assertEqual(
+            r.status_code, 201,
+            msg='Expected POST /projects/ to succeed.')
+
+        # An upload larger than the limit can never be accepted.
+        r = requests.post(
+            PREFIX + '/projects/{}/pii/'.format(PROJECT_ID),
+            params=dict(header='false'),
+            data=row * (limit + 1))
+        self.assertEqual(
+            r.status_code, 413,
+            msg='Expected POST /projects/{}/pii/ to fail.'.format(
+                PROJECT_ID))
+
+        r = requests.post(
+            PREFIX + '/projects/{}/pii/'.format(PROJECT_ID),
+            params=dict(header='false'),
+            data=row * limit)
+        self.assertEqual(
+            r.status_code, 202,
+            msg='Expected POST /projects/{}/pii/ to succeed.'.format(
+                PROJECT_ID))
+
+        # Accepted only once every row above has been hashed.
+        r = requests.post(
+            PREFIX + '/projects/{}/pii/'.format(PROJECT_ID),
+            params=dict(header='false'),
+            data=row * limit)
+        self.assertEqual(
+            r.status_code, 429,
+            msg='Expected POST /projects/{}/pii/ to fail.'.format(
+                PROJECT_ID))
+        self.assertGreater(
+            int(r.headers['Retry-After']), 0,
+            msg='Expected a Retry-After header.')
+
+    def tearDown(self):
+        requests.delete(PREFIX + '/projects/{}'.format(PROJECT_ID))
+
+
+class TestDedup(unittest.TestCase):
+    def setUp(self):
+        requests.delete(PREFIX + '/projects/{}'.format(PROJECT_ID))
+
+    @unittest.skipUnless(DB_URI, 'CLKHASH_SERVICE_DB_URI is not set.')
+    def test_duplicate_rows(self):
+        r = requests.post(
+            PREFIX + '/projects/',
+            params=dict(
+                project_id=PROJECT_ID,
+                secret_key=base64.b64encode(KEY),
+                dedup='true'),
+            json=AGE_SCHEMA)
+        self.assertEqual(
+            r.status_code, 201,
+            msg='Expected POST /projects/ to succeed.')
+
+        # The same person twice in one upload and once more in another,
+        # with different notes, which are not hashed, and ages written
+        # differently, which hash the same.
+        for data in ['Jane Doe,first,1968/05/19,F,42\n'
+                     'Jane Doe,second,1968/05/19,F,+42\n',
+                     'Jane Doe,,1968/05/19,F,042\n'
+                     'Peter Griffin,,1998/12/20,M,17\n']:
+            r = requests.post(
+                PREFIX + '/projects/{}/pii/'.format(PROJECT_ID),
+                params=dict(header='false'),
+                data=data)
+            self.assertEqual(
+                r.status_code, 202,
+                msg='Expected POST /projects/{}/pii/ to succeed.'.format(
+                    PROJECT_ID))
+
+        _wait_until_hashed(PROJECT_ID)
+
+        r = requests.get(
+            PREFIX + '/projects/{}/clks/'.format(PROJECT_ID),
+            params=dict(status='done'))
+        self.assertEqual(
+            r.status_code, 200,
+            msg='Expected GET /projects/{}/clks/ to succeed.'.format(
+                PROJECT_ID))
+        hashes = [clk['hash'] for clk in r.json()['clks']]
+        self.assertEqual(
+            len(hashes), 4,
+            msg='Unexpected output from GET /projects/{}/clks/'.format(
+                PROJECT_ID))
+        self.assertEqual(
+            len(set(hashes[:3])), 1,
+            msg='Expected duplicate rows to have identical clks.')
+
+        # One entry per distinct person: the duplicates were found in
+        # the index rather than hashed again.
+        self.assertEqual(
+            _count_rows('clk_digests', PROJECT_ID), 2,
+            msg='Expected one deduplication index entry per person.')
+
+    def tearDown(self):
+        requests.delete(PREFIX + '/projects/{}'.format(PROJECT_ID))
+
+
+class TestExports(unittest.TestCase):
+    def setUp(self):
+        requests.delete(PREFIX + '/projects/{}'.format(PROJECT_ID))
+
+    def test_exports(self):
+        # The project doesn't exist yet.
+        r = requests.post(
+            PREFIX + '/projects/{}/exports/'.format(PROJECT_ID))
+        self.assertEqual(
+            r.status_code, 404,
+            msg='Expected POST /projects/{}/exports/ to fail.'.format(
+                PROJECT_ID))
+
+        r = requests.post(
+            PREFIX + '/projects/',
+            params=dict(
+                project_id=PROJECT_ID,
+                secret_key=base64.b64encode(KEY)),
+            json=SCHEMA)
+        self.assertEqual(
+            r.status_code, 201,
+            msg='Expected POST /projects/ to succeed.')
+
+        r = requests.post(
+            PREFIX + '/projects/{}/pii/'.format(PROJECT_ID),
+            params=dict(header='false'),
+            data='Jane Doe,1968/05/19,F\n'
+                 'Peter Griffin,1998/12/20,M\n')
+        self.assertEqual(
+            r.status_code, 202,
+            msg='Expected POST /projects/{}/pii/ to succeed.'.format(
+                PROJECT_ID))
+
+        _wait_until_hashed(PROJECT_ID)
+
+        r = requests.post(
+            PREFIX + '/projects/{}/exports/'.format(PROJECT_ID))
+        self.assertEqual(
+            r.status_code, 202,
+            msg='Expected POST /projects/{}/exports/ to succeed.'.format(
+                PROJECT_ID))
+        export_id = r.json()['exportId']
+
+        # Wait for the parts to be written.
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            r = requests.get(PREFIX + '/projects/{}/exports/{}'.format(
+                PROJECT_ID, export_id))
+            self.assertEqual(
+                r.status_code, 200,
+                msg='Expected GET /projects/{}/exports/{} to succeed.'.format(
+                    PROJECT_ID, export_id))
+            if r.json()['status'] != 'in-progress':
+                break
+            time.sleep(0.5)
+
+        manifest = r.json()
+        self.assertEqual(
+            manifest['status'], 'done',
+            msg='Expected the export to finish.')
+        self.assertEqual(
+            sum(part['recordCount'] for part in manifest['parts']), 2,
+            msg='Expected every clk to be exported.')
+
+        r = requests.get(PREFIX + '/projects/{}/exports/{}'.format(
+            PROJECT_ID, 'no-such-export'))
+        self.assertEqual(
+            r.status_code, 404,
+            msg='Expected GET /projects/{}/exports/{} to fail.'.format(
+                PROJECT_ID, 'no-such-export'))
+
+    def tearDown(self):
+        requests.delete(PREFIX + '/projects/{}'.format(PROJECT_ID))
+
+
+@unittest.skipUnless(DB_URI, 'CLKHASH_SERVICE_DB_URI is not set.')
+class TestReplays(unittest.TestCase):
+    """Deliver a finished chunk's hashing task again, in this process."""
+
+    def setUp(self):
+        requests.delete(PREFIX + '/projects/{}'.format(PROJECT_ID))
+        # Tasks are called directly, never sent.
+        os.environ.setdefault('CLKHASH_SERVICE_BROKER_URI', 'memory://')
+        import clkhash_worker
+        self.worker = clkhash_worker
+
+    def _get_clks(self):
+        r = requests.get(PREFIX + '/projects/{}/clks/'.format(PROJECT_ID))
+        self.assertEqual(
+            r.status_code, 200,
+            msg='Expected GET /projects/{}/clks/ to succeed.'.format(
+                PROJECT_ID))
+        return r.json()['clks']
+
+    def _requeue(self, index):
+        """Mark a clk as outstanding again, as an interrupted task would
+        have left it."""
+        _execute("UPDATE clks SET status = 'QUEUED' "
+                 "WHERE project_id = :project_id AND index = :index",
+                 project_id=PROJECT_ID, index=index)
+        _execute('UPDATE projects '
+                 'SET outstanding_count = outstanding_count + 1 '
+                 'WHERE id = :project_id',
+                 project_id=PROJECT_ID)
+
+    def _outstanding_count(self):
+        [(count,)] = _execute(
+            'SELECT outstanding_count FROM projects WHERE id = :project_id',
+            project_id=PROJECT_ID)
+        return count
+
+    def test_replay(self):
+        r = requests.post(
+            PREFIX + '/projects/',
+            params=dict(
+                project_id=PROJECT_ID,
+                secret_key=base64.b64encode(KEY)),
+            json=SCHEMA)
+        self.assertEqual(
+            r.status_code, 201,
+            msg='Expected POST /projects/ to succeed.')
+
+        r = requests.post(
+            PREFIX + '/projects/{}/pii/'.format(PROJECT_ID),
+            params=dict(header='false'),
+            data='Jane Doe,1968/05/19,F\n'
+                 'Peter Griffin,1998/12/20,M\n'
+                 'Jane Doe,1968/05/19,X\n')
+        self.assertEqual(
+            r.status_code, 202,
+            msg='Expected POST /projects/{}/pii/ to succeed.'.format(
+                PROJECT_ID))
+
+        _wait_until_hashed(PROJECT_ID)
+        clks = self._get_clks()
+        self.assertEqual(
+            [clk['status'] for clk in clks], ['done', 'done', 'invalid-data'],
+            msg='Unexpected output from GET /projects/{}/clks/'.format(
+                PROJECT_ID))
+        self.assertEqual(
+            _count_rows('chunk_markers', PROJECT_ID), 1,
+            msg='Expected the finished chunk to have a marker.')
+
+        # A chunk with a marker is not looked at again, even if it has
+        # outstanding clks.
+        self._requeue(1)
+        self.worker.hash(PROJECT_ID, True, 0, 3)
+        self.assertEqual(
+            [clk['status'] for clk in self._get_clks()],
+            ['done', 'queued', 'invalid-data'],
+            msg='Expected the task to exit without hashing.')
+
+        # Without the marker, a failing task only touches outstanding
+        # clks.
+        _execute('DELETE FROM chunk_markers WHERE project_id = :project_id',
+                 project_id=PROJECT_ID)
+        _execute("UPDATE projects SET schema = '{}' WHERE id = :project_id",
+                 project_id=PROJECT_ID)
+        with self.assertRaises(Exception):
+            self.worker.hash(PROJECT_ID, True, 0, 3)
+        replayed = self._get_clks()
+        self.assertEqual(
+            [clk['status'] for clk in replayed],
+            ['done', 'error', 'invalid-data'],
+            msg='Expected the failure to leave finished clks alone.')
+        self.assertEqual(
+            replayed[0], clks[0],
+            msg='Expected the failure to leave finished clks alone.')
+        self.assertEqual(
+            self._outstanding_count(), 0,
+            msg='Expected no rows waiting to be hashed.')
+
     def tearDown(self):
+        self.worker.db_session.remove()
         requests.delete(PREFIX + '/projects/{}'.format(PROJECT_ID))
@@ -0,0 +1,39 @@
+import unittest
+
+import pii_codec
+
+
+class TestPiiCodec(unittest.TestCase):
+    def test_round_trip(self):
+        row = ['Jane Doe', '1968/05/19', 'F']
+        packed = pii_codec.pack(row, [True, True, True])
+        self.assertEqual(pii_codec.unpack(packed), row)
+
+    def test_dropped_columns(self):
+        row = ['Jane Doe', 'some notes', '1968/05/19', 'F', '42']
+        packed = pii_codec.pack(row, [True, False, True, True, False])
+        self.assertEqual(pii_codec.unpack(packed),
+                         ['Jane Doe', '', '1968/05/19', 'F', ''])
+        self.assertLess(len(packed),
+                        len(pii_codec.pack(row, [True] * len(row))))
+
+    def test_row_length_is_kept(self):
+        # Whatever the length of `keep`.
+        packed = pii_codec.pack(['a', 'b', 'c'], [True])
+        self.assertEqual(pii_codec.unpack(packed), ['a', '', ''])
+
+        packed = pii_codec.pack(['a'], [True, True, True])
+        self.assertEqual(pii_codec.unpack(packed), ['a'])
+
+        self.assertEqual(pii_codec.unpack(pii_codec.pack([], [])), [])
+
+    def test_values(self):
+        # Empty, non-ASCII, and long enough for a multi-byte length.
+        row = ['', 'Zoë Ñúñez 山田', 'x' * 300, ',"\n']
+        packed = pii_codec.pack(row, [True] * len(row))
+        self.assertEqual(pii_codec.unpack(packed), row)
+
+    def test_too_many_columns(self):
+        row = [''] * (pii_codec.MAX_COLUMNS + 1)
+        with self.assertRaises(ValueError):
+            pii_codec.pack(row, [True])
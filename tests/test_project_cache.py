@@ -0,0 +1,70 @@
+import unittest
+
+import project_cache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestProjectCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = project_cache.ProjectCache(maxsize=2, ttl=60,
+                                                clock=self.clock)
+
+    def test_get(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.stats(),
+                         {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_ttl(self):
+        self.cache.put('a', 1)
+        self.clock.now = 59
+        self.assertEqual(self.cache.get('a'), 1)
+        self.clock.now = 60
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_put_resets_ttl(self):
+        self.cache.put('a', 1)
+        self.clock.now = 30
+        self.cache.put('a', 2)
+        self.clock.now = 60
+        self.assertEqual(self.cache.get('a'), 2)
+
+    def test_lru_eviction(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.get('a')  # Now 'b' is the least recently used.
+        self.cache.put('c', 3)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 3)
+
+    def test_invalidate(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.invalidate('a')
+        self.cache.invalidate('no-such-project')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('b'), 2)
+
+    def test_clear(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+
+    def test_disabled(self):
+        cache = project_cache.ProjectCache(maxsize=0, ttl=60,
+                                           clock=self.clock)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))